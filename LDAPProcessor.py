@@ -1,18 +1,99 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
 import os
 import sys
-from ConfigParser import SafeConfigParser
-import codecs
+from configparser import ConfigParser
 import ldap
 from ldap.controls import SimplePagedResultsControl
-import uuid
 import time
 import json
 import struct
 
+#Pick the fastest available JSON serializer. _dumps returns one compact JSON document 
+#as UTF-8 encoded bytes terminated by a newline.
+try:
+    import orjson
+
+    def _dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS | orjson.OPT_APPEND_NEWLINE | 
+                orjson.OPT_NON_STR_KEYS)
+except ImportError:
+    try:
+        import ujson
+
+        def _dumps(obj):
+            return (ujson.dumps(obj, ensure_ascii=False, sort_keys=True) + 
+                    u'\n').encode('utf-8')
+    except ImportError:
+        def _dumps(obj):
+            return (json.dumps(obj, separators=(',', ':'), ensure_ascii=False, 
+                    sort_keys=True) + u'\n').encode('utf-8')
+
+_decode = bytes.decode
+
+#Struct formats are compiled once here and only their bound unpack methods are kept.
+#objectGUID as the six big endian fields of the canonical UUID string
+_unpack_guid = struct.Struct('>LHHHLH').unpack
+
+#SID header: version, sub authority count and 48 bit big endian authority split in 
+#its high 16 and low 32 bits
+_unpack_sid_header = struct.Struct('>BBHL').unpack_from
+#Little endian sub authorities for every possible count
+_unpack_sid_machines = [struct.Struct('<%dL' % length).unpack_from for length in range(256)]
+
+def _parse_sid(objectSid):
+    """Parses a binary objectSid into its numeric parts.
+
+    Args:
+        objectSid (bytes): ObjectSid byte array as returned from AD.
+
+    Returns:
+        tuple: version (int), authority (int) and tuple of sub authorities (int).
+    """
+    version, length, authority_high, authority_low = _unpack_sid_header(objectSid, 0)
+    assert version == 1, version
+    assert len(objectSid) == 8 + 4 * length
+
+    authority = authority_high << 32 | authority_low
+    return version, authority, _unpack_sid_machines[length](objectSid, 8)
+
+def _h_guid(values):
+    """Converts objectGUID byte arrays to UUID strings."""
+    return [u'%08x-%04x-%04x-%04x-%08x%04x' % _unpack_guid(objectGUID) 
+            for objectGUID in values]
+
+def _h_mail(values):
+    """Splits comma separated mail values into a flat list of addresses.
+
+    Empty entries are dropped and invalid UTF-8 is replaced rather than raising.
+    """
+    value = []
+    for each in values:
+        for mail in each.split(b','):
+            mail = mail.strip()
+            if mail:
+                value.append(mail.decode('utf-8', 'replace'))
+    return value
+
+def _h_default(values):
+    """Decodes attribute values as UTF-8, falling back to their representation."""
+    try:
+        return [_decode(each, 'utf-8') for each in values]
+    except UnicodeDecodeError:
+        return str(values)
+
+#Attribute specific value handlers, all other attributes use _h_default. objectSid is
+#bound to AD_parser.decode_sid in build_json.
+_HANDLERS = {
+    u'objectGUID': _h_guid,
+    u'mail': _h_mail,
+}
+
 class AD_parser:
+    #Parsed configuration files keyed by absolute path, as (mtime, parser)
+    _CONFIG_CACHE = {}
+
     def __init__(self, domain, debug_level=0):
         """Class used to connect to Telenors different AD controllers.
 
@@ -53,11 +134,18 @@ class AD_parser:
             >>> ad.build_json(results, output_file)
             >>> ad.disconnect()
         """
-        #Read correct domain config
-        parser = SafeConfigParser()
+        #Read correct domain config, reusing the parsed file if it is unchanged
+        config_path = os.path.abspath('ldap.ini')
+        mtime = os.stat(config_path).st_mtime
+        cached = AD_parser._CONFIG_CACHE.get(config_path)
 
-        with codecs.open('ldap.ini', 'r', encoding='utf-8') as f:
-            parser.readfp(f)
+        if cached is not None and cached[0] == mtime:
+            parser = cached[1]
+        else:
+            parser = ConfigParser()
+            with open(config_path, 'r', encoding='utf-8') as f:
+                parser.read_file(f)
+            AD_parser._CONFIG_CACHE[config_path] = (mtime, parser)
         
         #Check if input domain exists in config file
         if parser.has_section(domain) is False:
@@ -105,7 +193,7 @@ class AD_parser:
         try:
             l = ldap.initialize(self.LDAP_PROTOCOL + self.LDAP_SERVER + ":" + self.LDAP_PORT)
             return l
-        except ldap.LDAPError, e:
+        except ldap.LDAPError as e:
             print ("Initialisation failed: " + e.args[0]['desc'])
             sys.exit()
 
@@ -122,10 +210,10 @@ class AD_parser:
         try:
             self.ldap.simple_bind_s(self.LDAP_DN, self.LDAP_DN_PASS)
             return True
-        except ldap.LDAPError, e:
+        except ldap.LDAPError as e:
             print ("Bind operation failed: " + e.args[0]['desc'])
             sys.exit()
-        except ldap.INVALID_CREDENTIALS, e:
+        except ldap.INVALID_CREDENTIALS as e:
             print ("Invalid credentials in bind operation: " + e.args[0]['desc'])
             sys.exit()
     
@@ -137,7 +225,7 @@ class AD_parser:
         """
         try:
             self.ldap.unbind_ext_s()
-        except ldap.LDAPError, e:
+        except ldap.LDAPError as e:
             print ("Unbind operation failed: " + e.args[0]['desc'])
             sys.exit()
     
@@ -156,7 +244,7 @@ class AD_parser:
         """
         try:
             results = self.ldap.search_s(self.LDAP_BASE, ldap.SCOPE_SUBTREE, filterstr)
-        except ldap.SIZELIMIT_EXCEEDED, e:
+        except ldap.SIZELIMIT_EXCEEDED as e:
             print('Warning: Server-side size limit exceeded. ' + e.args[0]['desc'])
             print('Try using paged_search instead.')
             self.disconnect()
@@ -168,13 +256,16 @@ class AD_parser:
         """Converts search results from list to JSON.
         
         Converts the default search results from a list/tuples format into JSON unicode output.
+        The output is newline delimited JSON (NDJSON): one compact JSON object per user per 
+        line, with sorted keys.
 
         Decodes the following fields:
-        objectGUID: Used the built-in python UUID library.
+        objectGUID: Formats the byte array returned from AD as a UUID string.
         objectSid: Decodes the byte array returned from AD.
         
         Args:
-            search_results (list): The search results returned from search.
+            search_results (iterable): The search results returned from search or 
+                paged_search. Consumed once.
             output (str): Path to output file.
         
         Raises:
@@ -183,60 +274,56 @@ class AD_parser:
         if os.path.isdir(output):
             error_msg = u'Output file is a directory, needs filename.'
             raise ValueError(error_msg)
-        else:
-            f = open(output, 'a')
-            try:
-                os.utime(output, None)
-            finally:
-                f.close()
-        
-        f = codecs.open(output, "w", "utf-8")
-        os.chmod(output, 0440)
+
+        #Create or truncate the output read-only in one call. fchmod covers files that 
+        #already existed, since os.open only applies the mode on creation.
+        fd = os.open(output, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o440)
+        os.fchmod(fd, 0o440)
+        f = os.fdopen(fd, 'wb', 1 << 20)
+
+        #Fields shared by every user in this extract
+        base = {
+            u'extractTime': str(time.time()),
+            u'datasource': self.SOURCE,
+            u'datasource_type': self.SOURCE_TYPE,
+            u'datasource_value': self.SOURCE_VALUE,
+        }
+
+        handlers = dict(_HANDLERS)
+        handlers[u'objectSid'] = self.decode_sid
+
+        #Serialized users are written in batches of LDAP_PAGE_SIZE
+        batch = []
 
         for user in search_results:
-            json_output = {}
-            current_time = unicode(time.mktime(time.localtime()))
-            
-            json_output['extractTime'] = current_time
-            json_output['datasource'] = self.SOURCE
-            json_output['datasource_type'] = self.SOURCE_TYPE
-            json_output['datasource_value'] = self.SOURCE_VALUE
-            
-            for item in user[1].iteritems():
-                key = unicode(item[0])
-                
-                if key == u'objectGUID':
-                    value = []
-                    for objectGUID in item[1]:
-                        value.append(unicode(uuid.UUID(bytes=objectGUID)))
-                elif key == u'objectSid':
-                    value = self.decode_sid(item[1])
-                elif key == u'mail':
-                    value = []
-                    for each in item[1]:
-                        split_mail = each.split(',')
-                        strip_mail = [x.strip() for x in split_mail]
-                        for mail in strip_mail:
-                            try:
-                                value.append(unicode(mail))
-                            except UnicodeDecodeError:
-                                value.append(mail.decode('utf-8'))
-                else:
-                    try:
-                        value = []
-                        length = len(item[1])
-                        for i, each in enumerate(item[1]):
-                            value.append(item[1][i].decode('utf-8'))
-                    except UnicodeDecodeError:
-                        value = unicode(item[1])
-                
-                json_output[key] = value
-
-            json.dump(json_output, f, indent=4, separators=(',', ': '), ensure_ascii=False, 
-                sort_keys=True)
-            f.write(u'\n')
+            batch.append(_dumps(self._build_user(user, base, handlers)))
+            if len(batch) >= self.LDAP_PAGE_SIZE:
+                f.write(b''.join(batch))
+                batch = []
+
+        if batch:
+            f.write(b''.join(batch))
         f.close()
 
+    def _build_user(self, user, base, handlers):
+        """Converts a single search result to a dictionary ready for serialization.
+
+        Args:
+            user (tuple): Distinguished name and attribute dictionary as returned from AD.
+            base (dict): Fields shared by all users, copied into the result.
+            handlers (dict): Value handlers keyed by attribute name.
+
+        Returns:
+            dict: The decoded attributes of the user.
+        """
+        json_output = base.copy()
+
+        for key, values in user[1].items():
+            handler = handlers.get(key, _h_default)
+            json_output[key] = handler(values)
+
+        return json_output
+
     def decode_sid(self, objectSids):
         """Converts objectSids to human readable SID.
         
@@ -254,20 +341,10 @@ class AD_parser:
         """
         processed_sids = []
         for objectSid in objectSids:
-            version = struct.unpack('B', objectSid[0:1])[0]
-            assert version == 1, version
-            
-            length = struct.unpack('B', objectSid[1:2])[0]
-            authority = unicode(struct.unpack('>Q', '\x00\x00' + objectSid[2:8])[0])
-            value = u'S-'+unicode(version)+u'-'+authority
-            binary = objectSid[8:]
-            assert len(binary) == 4 * length
-            
-            for i in xrange(length):
-                machine = unicode(struct.unpack('<L', binary[4*i:4*(i+1)])[0])
-                value += u'-'+machine
-
-            processed_sids.append(value)
+            version, authority, machines = _parse_sid(objectSid)
+            parts = [u'S', str(version), str(authority)]
+            parts.extend(map(str, machines))
+            processed_sids.append(u'-'.join(parts))
         return processed_sids
 
     def paged_search(self, filterstr='(objectClass=*)', attrlist=None, 
@@ -286,40 +363,41 @@ class AD_parser:
             attrsonly (bool): Only gets attributes, not values.
             timeout (int): Time the search waits for results before giving up.
         
-        Returns:
-            list: List with all results.
+        Yields:
+            tuple: Distinguished name and attribute dictionary for each result, page by page.
         """
+        #Bind names used on every page locally
+        search = self.ldap.search_ext
+        result3 = self.ldap.result3
+        base = self.LDAP_BASE
+        scope = ldap.SCOPE_SUBTREE
+        page_oid = SimplePagedResultsControl.controlType
+
         #Simple paged results control to keep track of the search status
-        req_ctrl = SimplePagedResultsControl(ldap.LDAP_CONTROL_PAGE_OID, True, 
-                (self.LDAP_PAGE_SIZE, ''))
+        req_ctrl = SimplePagedResultsControl(True, size=self.LDAP_PAGE_SIZE, cookie='')
         
         #Send first search request
-        msgid = self.ldap.search_ext(self.LDAP_BASE, ldap.SCOPE_SUBTREE, filterstr=filterstr, 
-                attrlist=attrlist, serverctrls=[req_ctrl], timeout=timeout)
-
-        all_results = []
+        msgid = search(base, scope, filterstr=filterstr, attrlist=attrlist, 
+                serverctrls=[req_ctrl], timeout=timeout)
 
         while True:
-            rtype, rdata, rmsgid, rctrls = self.ldap.result3(msgid)
-            all_results.extend(rdata)
+            rtype, rdata, rmsgid, rctrls = result3(msgid)
+            yield from rdata
 
             #Extract the simple paged results response control
-            pctrls = [c for c in rctrls if c.controlType == ldap.LDAP_CONTROL_PAGE_OID]
+            pctrls = [c for c in rctrls if c.controlType == page_oid]
 
             if pctrls:
-                est, cookie = pctrls[0].controlValue
+                cookie = pctrls[0].cookie
                 if cookie:
                     #Copy cookie from response control to request control
-                    req_ctrl.controlValue = (self.LDAP_PAGE_SIZE, cookie)
+                    req_ctrl.cookie = cookie
                     
                     #Continue the search with updated request control
-                    msgid = self.ldap.search_ext(self.LDAP_BASE, ldap.SCOPE_SUBTREE, 
-                            filterstr=filterstr, attrlist=attrlist, serverctrls=[req_ctrl],
-                            timeout=timeout)
+                    msgid = search(base, scope, filterstr=filterstr, attrlist=attrlist, 
+                            serverctrls=[req_ctrl], timeout=timeout)
                 else:
                     break
             else:
                 print("Warning: Server ignores RFC 2696 control.")
                 break
-
-        return all_results
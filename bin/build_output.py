@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
 import os
@@ -25,25 +25,17 @@ parser.add_argument('-ad', '--ad_server', dest='ad', choices=['op', 'telenor'],
 args = parser.parse_args()
 
 if args.output == None:
-    timestamp = unicode(datetime.datetime.utcnow().isoformat())
-    default_file_name = timestamp + u'-' + unicode(args.ad) + u'_ad.json'
+    timestamp = str(datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None).isoformat())
+    default_file_name = timestamp + u'-' + str(args.ad) + u'_ad.json'
     args.output = u'' + default_file_name
 
-if os.path.isfile(args.output):
-    OUTPUT_FILE = args.output
-elif os.path.isdir(args.output):
+#build_json creates or truncates the output file itself
+if os.path.isdir(args.output):
     error_msg = u'Output file is a directory, needs filename.'
     raise ValueError(error_msg)
-else:
-    file = open(args.output, 'a')
-    try:
-        os.utime(args.output, None)
-        OUTPUT_FILE = args.output
-    finally:
-        file.close()
+OUTPUT_FILE = args.output
 
 ad = LDAPProcessor.AD_parser(args.ad)
-results = ad.paged_search(filterstr=args.search)
 if args.type == u'json':
-    ad.build_json(results, OUTPUT_FILE)
+    ad.build_json(ad.paged_search(filterstr=args.search), OUTPUT_FILE)
 ad.disconnect()